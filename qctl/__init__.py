@@ -1,2 +1,2 @@
 """qctl package - internal modules for queuectl CLI"""
-__all__ = ["db", "worker"]
+__all__ = ["db", "db_pool", "worker"]
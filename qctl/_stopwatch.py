@@ -0,0 +1,76 @@
+"""Wait for the worker stopfile to appear.
+
+On Linux this blocks on an inotify watch of the stopfile's directory, so
+there is no stat() per poll. Elsewhere (or if inotify is unavailable) it
+falls back to checking os.path.exists every `interval` seconds.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct("iIII")
+
+
+def _libc():
+    if not hasattr(os, "uname") or os.uname().sysname != "Linux":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def _poll(path, stop_event, interval):
+    while not stop_event.is_set():
+        if os.path.exists(path):
+            return True
+        stop_event.wait(interval)
+    return False
+
+
+def wait_for_file(path, stop_event, interval=0.5):
+    """Block until path exists (True) or stop_event is set (False).
+
+    `interval` bounds how long a stop_event set elsewhere goes unnoticed.
+    """
+    libc = _libc()
+    if libc is None:
+        return _poll(path, stop_event, interval)
+    directory = os.path.dirname(os.path.abspath(path))
+    name = os.fsencode(os.path.basename(path))
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return _poll(path, stop_event, interval)
+    try:
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CREATE | IN_MOVED_TO) < 0:
+            return _poll(path, stop_event, interval)
+        # the watch is in place, so a file created from here on can't be missed
+        if os.path.exists(path):
+            return True
+        while not stop_event.is_set():
+            ready, _, _ = select.select([fd], [], [], interval)
+            if not ready:
+                continue
+            try:
+                buf = os.read(fd, 4096)
+            except BlockingIOError:
+                continue
+            pos = 0
+            while pos + _EVENT.size <= len(buf):
+                _wd, _mask, _cookie, length = _EVENT.unpack_from(buf, pos)
+                pos += _EVENT.size
+                if buf[pos:pos + length].rstrip(b"\0") == name:
+                    return True
+                pos += length
+        return False
+    finally:
+        os.close(fd)
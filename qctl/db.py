@@ -1,14 +1,77 @@
 """Database layer for queuectl using SQLite (qctl copy)"""
 import json
 import os
+import re
 import sqlite3
-from datetime import datetime, timedelta
+import sys
+import time
+from datetime import datetime, timezone
+
+from qctl.db_pool import exec_cached, get_conn
+
+# applied to every connection we open; synchronous/busy_timeout/temp_store
+# are per-session, so a fresh connection would otherwise run with defaults
+_PRAGMAS = (
+    # only takes effect on a new, still-empty db (so it must precede
+    # journal_mode, which writes the header); a no-op on existing files
+    "PRAGMA page_size=8192;",
+    "PRAGMA busy_timeout=30000;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-65536;",
+    # read hot pages straight from the mapping instead of a pread() each
+    "PRAGMA mmap_size=268435456;",
+    # keep the -wal file small: checkpoint often, truncate it back afterwards
+    "PRAGMA wal_autocheckpoint=200;",
+    "PRAGMA journal_size_limit=67108864;",
+)
+
+
+# durability knobs users may override with `config set <key> <value>`:
+# key -> (default, allowed values); applied by _open after _PRAGMAS
+_DURABILITY = {
+    "journal_mode": ("WAL", ("WAL", "MEMORY")),
+    "synchronous": ("NORMAL", ("OFF", "NORMAL", "FULL")),
+}
+
+
+class _Connection(sqlite3.Connection):
+    """Connection that can hold cursors reused per SQL text (see exec_cached)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stmts = {}
+
+
+def _open(dbpath):
+    conn = sqlite3.connect(dbpath, timeout=30, isolation_level=None, cached_statements=256, check_same_thread=False, factory=_Connection)
+    for p in _PRAGMAS:
+        conn.execute(p)
+    try:
+        chosen = dict(conn.execute("SELECT key, value FROM config WHERE key IN ('journal_mode','synchronous')"))
+    except sqlite3.OperationalError:
+        chosen = {}  # new db: no config table yet
+    for key, (default, allowed) in _DURABILITY.items():
+        value = str(chosen.get(key) or "").upper()
+        if value not in allowed:
+            if value:
+                print(f"qctl: ignoring config {key}={chosen[key]!r} (allowed: {'|'.join(allowed)}); using {default}", file=sys.stderr)
+            value = default
+        try:
+            row = conn.execute(f"PRAGMA {key}={value}").fetchone()
+        except sqlite3.OperationalError as e:
+            # e.g. leaving WAL while other connections are open
+            print(f"qctl: could not set {key}={value} ({e}); keeping the current mode", file=sys.stderr)
+            continue
+        # journal_mode answers with the mode actually in effect
+        if row is not None and str(row[0]).upper() != value:
+            print(f"qctl: {key} is {row[0]}, not the configured {value}", file=sys.stderr)
+    return conn
 
 
 def init_db(path="queue.db"):
     need = not os.path.exists(path)
-    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
-    conn.execute("PRAGMA journal_mode=WAL;")
+    # the pooled connection, so later db.* calls in this thread reuse it
+    conn = get_conn(path)
     cur = conn.cursor()
     if need:
         cur.executescript(
@@ -26,7 +89,12 @@ def init_db(path="queue.db"):
             priority INTEGER DEFAULT 0,
             run_at TEXT,
             log_path TEXT,
-            timeout INTEGER
+            timeout INTEGER,
+            created_at_ms INTEGER,
+            updated_at_ms INTEGER,
+            next_attempt_at_ms INTEGER,
+            run_at_ms INTEGER,
+            worker_id TEXT
         );
 
         CREATE TABLE config (
@@ -45,6 +113,7 @@ def init_db(path="queue.db"):
         INSERT INTO metrics(key, value) VALUES('jobs_retried', 0);
         """
         )
+        _create_indexes(cur)
         conn.commit()
     else:
         # run migrations: ensure columns exist
@@ -59,6 +128,16 @@ def init_db(path="queue.db"):
             cur.execute("ALTER TABLE jobs ADD COLUMN log_path TEXT")
         if 'timeout' not in cols:
             cur.execute("ALTER TABLE jobs ADD COLUMN timeout INTEGER")
+        if 'worker_id' not in cols:
+            cur.execute("ALTER TABLE jobs ADD COLUMN worker_id TEXT")
+        if 'created_at_ms' not in cols:
+            # timestamps moved to INTEGER epoch-ms columns; the TEXT ones are
+            # kept for old rows and derived from *_ms on read
+            for c in ("created_at", "updated_at", "next_attempt_at", "run_at"):
+                cur.execute(f"ALTER TABLE jobs ADD COLUMN {c}_ms INTEGER")
+                cur.execute(f"UPDATE jobs SET {c}_ms = CAST(ROUND((julianday({c}) - 2440587.5) * 86400000) AS INTEGER) WHERE {c} IS NOT NULL")
+            # the claim index used to be on the TEXT created_at
+            cur.execute("DROP INDEX IF EXISTS idx_jobs_ready")
         # ensure metrics table exists
         cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='metrics'")
         if not cur.fetchone():
@@ -77,31 +156,74 @@ def init_db(path="queue.db"):
         cur.execute("SELECT value FROM config WHERE key='backoff_base'")
         if not cur.fetchone():
             cur.execute("INSERT INTO config(key,value) VALUES('backoff_base','2')")
+        _create_indexes(cur)
         conn.commit()
     return conn
 
 
-def enqueue_job(dbpath, job):
-    conn = sqlite3.connect(dbpath, timeout=30)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO jobs(id,command,state,attempts,max_retries,created_at,updated_at) VALUES (?,?,?,?,?,?,?)",
-        (
-            job["id"],
-            job["command"],
-            job.get("state", "pending"),
-            job.get("attempts", 0),
-            job.get("max_retries", 3),
-            job.get("created_at"),
-            job.get("updated_at"),
-        ),
+def _create_indexes(cur):
+    # idx_jobs_ready matches the claim query in fetch_and_lock_job (pending
+    # rows only, in ORDER BY order); the claim names it with INDEXED BY since
+    # the planner can otherwise prefer a state index plus a sort.
+    # idx_jobs_state_created serves the list/stats filters in list order
+    # (WHERE state=? ORDER BY created_at_ms) and replaces the old idx_jobs_state.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(priority DESC, created_at_ms) WHERE state='pending'")
+    cur.execute("DROP INDEX IF EXISTS idx_jobs_state")
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_jobs_state_created'")
+    if cur.fetchone() is None:
+        cur.execute("CREATE INDEX idx_jobs_state_created ON jobs(state, created_at_ms)")
+        # give the planner stats for the new index once, not on every start
+        cur.execute("ANALYZE jobs")
+
+
+class DuplicateJobError(Exception):
+    """A job with this id is already in the queue."""
+
+
+_INSERT_JOB_SQL = "INSERT INTO jobs(id,command,state,attempts,max_retries,created_at_ms,updated_at_ms) VALUES (?,?,?,?,?,?,?)"
+# duplicate check and insert in one statement: no row back means the id exists
+_INSERT_NEW_JOB_SQL = _INSERT_JOB_SQL + " ON CONFLICT(id) DO NOTHING RETURNING id"
+
+
+def _job_row(job, now):
+    return (
+        job["id"],
+        job["command"],
+        job.get("state", "pending"),
+        job.get("attempts", 0),
+        job.get("max_retries", 3),
+        _to_ms(job.get("created_at"), now),
+        _to_ms(job.get("updated_at"), now),
     )
-    conn.commit()
-    conn.close()
 
 
-def _now_ts():
-    return datetime.utcnow().isoformat() + "Z"
+def enqueue_job(dbpath, job):
+    row = _job_row(job, _now_ms())
+    if not exec_cached(get_conn(dbpath), _INSERT_NEW_JOB_SQL, row).fetchall():
+        raise DuplicateJobError(row[0])
+
+
+def enqueue_jobs(dbpath, jobs):
+    """Insert many jobs in a single transaction; all or none are added."""
+    conn = get_conn(dbpath)
+    now = _now_ms()
+    rows = [_job_row(job, now) for job in jobs]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # one prepared INSERT stepped per row; the single COMMIT is the win
+        conn.executemany(_INSERT_JOB_SQL, rows)
+        conn.execute("COMMIT")
+    except Exception:
+        # after some errors (SQLITE_FULL, IOERR, ...) SQLite has already
+        # rolled back; a second ROLLBACK would mask the original error
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    return len(rows)
+
+
+def _now_ms():
+    return time.time_ns() // 1_000_000
 
 
 def _parse_ts(s):
@@ -110,129 +232,265 @@ def _parse_ts(s):
     return datetime.fromisoformat(s.replace("Z", ""))
 
 
-def fetch_and_lock_job(dbpath):
-    conn = sqlite3.connect(dbpath, timeout=30)
-    cur = conn.cursor()
-    now = _now_ts()
-    # Safe claim: select candidate, then atomically update by id if still pending
-    while True:
-        cur.execute(
-            "SELECT id FROM jobs WHERE state='pending' AND (next_attempt_at IS NULL OR next_attempt_at<=?) AND (run_at IS NULL OR run_at<=?) ORDER BY priority DESC, created_at LIMIT 1",
-            (now, now),
-        )
-        row = cur.fetchone()
-        if not row:
-            conn.close()
-            return None
-        jid = row[0]
-        # try to claim
-        cur.execute("UPDATE jobs SET state='processing', updated_at=? WHERE id=? AND state='pending'", (now, jid))
-        if cur.rowcount == 1:
-            # claimed
-            cur.execute(
-                "SELECT id,command,state,attempts,max_retries,created_at,updated_at,next_attempt_at,last_error,priority,run_at,log_path,timeout FROM jobs WHERE id=?",
-                (jid,),
-            )
-            row2 = cur.fetchone()
-            conn.commit()
-            conn.close()
-            if not row2:
-                return None
-            keys = [
-                "id",
-                "command",
-                "state",
-                "attempts",
-                "max_retries",
-                "created_at",
-                "updated_at",
-                "next_attempt_at",
-                "last_error",
-                "priority",
-                "run_at",
-                "log_path",
-                "timeout",
-            ]
-            return dict(zip(keys, row2))
-        # else someone else claimed it first; loop and try next
+def _to_ms(value, default):
+    """Epoch ms for an int or ISO-8601 (UTC) string; default if unusable."""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        dt = _parse_ts(value)
+    except ValueError:
+        return default
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
 
 
-def complete_job(dbpath, job_id):
-    conn = sqlite3.connect(dbpath, timeout=30)
-    cur = conn.cursor()
-    now = _now_ts()
-    cur.execute("UPDATE jobs SET state='completed', updated_at=? WHERE id=?", (now, job_id))
-    conn.commit()
-    conn.close()
+def _iso_expr(col):
+    # TEXT view of an epoch-ms column, falling back to the legacy TEXT value
+    return f"COALESCE(strftime('%Y-%m-%dT%H:%M:%fZ', {col}_ms / 1000.0, 'unixepoch'), {col})"
 
 
-def fail_job(dbpath, job_id, attempts, max_retries, error_msg, backoff_base=2):
-    conn = sqlite3.connect(dbpath, timeout=30)
-    cur = conn.cursor()
-    now_dt = datetime.utcnow()
+def _iso(col):
+    return f"{_iso_expr(col)} AS {col}"
+
+
+_JOB_COLS = (
+    "id,command,state,attempts,max_retries,"
+    + ",".join(_iso(c) for c in ("created_at", "updated_at", "next_attempt_at"))
+    + ",last_error"
+)
+_CLAIM_COLS = _JOB_COLS + ",priority," + _iso("run_at") + ",log_path,timeout"
+
+
+_CLAIM_KEYS = (
+    "id",
+    "command",
+    "state",
+    "attempts",
+    "max_retries",
+    "created_at",
+    "updated_at",
+    "next_attempt_at",
+    "last_error",
+    "priority",
+    "run_at",
+    "log_path",
+    "timeout",
+)
+
+
+# Hot statements, run once or more per job by every worker; they go through
+# exec_cached so each connection keeps one cursor per statement.
+
+# single statement claim: the subselect and update run under one write lock,
+# so no other worker can claim the same rows in between
+# jobs without a log_path get <log prefix><id>.log in the same write; a NULL
+# prefix leaves log_path NULL
+_CLAIM_SQL = f"""
+    UPDATE jobs SET state='processing', worker_id=?, updated_at_ms=?, log_path=COALESCE(log_path, ? || id || '.log')
+    WHERE id IN (
+        SELECT id FROM jobs INDEXED BY idx_jobs_ready
+        WHERE state='pending' AND (next_attempt_at_ms IS NULL OR next_attempt_at_ms<=?) AND (run_at_ms IS NULL OR run_at_ms<=?)
+        ORDER BY priority DESC, created_at_ms LIMIT ?
+    )
+    RETURNING {_CLAIM_COLS}
+    """
+_ASSIGN_SQL = "UPDATE jobs SET worker_id=? WHERE id=? AND state='processing'"
+_COMPLETE_SQL = "UPDATE jobs SET state='completed', updated_at_ms=? WHERE id=?"
+_FAIL_DEAD_SQL = "UPDATE jobs SET state='dead', attempts=?, updated_at_ms=?, last_error=? WHERE id=?"
+_FAIL_RETRY_SQL = "UPDATE jobs SET state='pending', attempts=?, updated_at_ms=?, next_attempt_at_ms=?, last_error=? WHERE id=?"
+_METRIC_SQL = "INSERT INTO metrics(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=value+excluded.value"
+
+
+def fetch_and_lock_batch(dbpath, limit=8, logs_dir=None, worker_id=None):
+    """Atomically claim up to `limit` due pending jobs, marking them processing.
+    Jobs with no log_path get logs_dir/<id>.log assigned (if logs_dir is given);
+    worker_id is recorded on each claimed row.
+    Returns a list of job dicts in claim order (possibly empty).
+    """
+    now = _now_ms()
+    prefix = os.path.join(logs_dir, "") if logs_dir else None
+    cur = exec_cached(get_conn(dbpath), _CLAIM_SQL, (worker_id, now, prefix, now, now, limit))
+    # fetchall() so the statement is reset and the write committed right away
+    jobs = [dict(zip(_CLAIM_KEYS, r)) for r in cur.fetchall()]
+    # RETURNING order is unspecified; restore the claim order
+    jobs.sort(key=lambda j: (-(j["priority"] or 0), j["created_at"] or ""))
+    return jobs
+
+
+def fetch_and_lock_job(dbpath, logs_dir=None, worker_id=None):
+    """Atomically pick a pending job that's due and mark it processing.
+    Returns job row dict or None.
+    """
+    jobs = fetch_and_lock_batch(dbpath, limit=1, logs_dir=logs_dir, worker_id=worker_id)
+    return jobs[0] if jobs else None
+
+
+def assign_job(dbpath, job_id, worker_id):
+    """Record which worker is running an already-claimed job."""
+    exec_cached(get_conn(dbpath), _ASSIGN_SQL, (worker_id, job_id))
+
+
+def release_jobs(dbpath, job_ids):
+    """Put claimed jobs back to pending without counting an attempt.
+
+    For jobs that never started, or were cut short through no fault of their own.
+    """
+    cur = get_conn(dbpath).cursor()
+    now = _now_ms()
+    cur.executemany(
+        "UPDATE jobs SET state='pending', worker_id=NULL, updated_at_ms=? WHERE id=? AND state='processing'",
+        [(now, jid) for jid in job_ids],
+    )
+
+
+def _complete(conn, job_id):
+    now = _now_ms()
+    exec_cached(conn, _COMPLETE_SQL, (now, job_id))
+
+
+def _fail(conn, job_id, attempts, max_retries, error_msg, backoff_base):
+    now = _now_ms()
     attempts = attempts + 1
     if attempts > max_retries:
-        cur.execute("UPDATE jobs SET state='dead', attempts=?, updated_at=?, last_error=? WHERE id=?", (attempts, now_dt.isoformat() + "Z", error_msg, job_id))
+        exec_cached(conn, _FAIL_DEAD_SQL, (attempts, now, error_msg, job_id))
     else:
         delay_seconds = (backoff_base ** attempts)
-        next_time = (now_dt + timedelta(seconds=delay_seconds)).isoformat() + "Z"
-        cur.execute(
-            "UPDATE jobs SET state='pending', attempts=?, updated_at=?, next_attempt_at=?, last_error=? WHERE id=?",
-            (attempts, now_dt.isoformat() + "Z", next_time, error_msg, job_id),
-        )
-    conn.commit()
-    conn.close()
+        next_time = now + int(delay_seconds * 1000)
+        exec_cached(conn, _FAIL_RETRY_SQL, (attempts, now, next_time, error_msg, job_id))
 
 
-def list_jobs(dbpath, state=None):
-    conn = sqlite3.connect(dbpath)
-    cur = conn.cursor()
+def complete_job(dbpath, job_id):
+    _complete(get_conn(dbpath), job_id)
+
+
+def fail_job(dbpath, job_id, attempts, max_retries, error_msg, backoff_base=2):
+    _fail(get_conn(dbpath), job_id, attempts, max_retries, error_msg, backoff_base)
+
+
+def finalize_job(dbpath, job_id, success, error_msg=None, attempts=0, max_retries=3, backoff_base=2):
+    """Record a job's outcome and bump the metrics counters in one transaction."""
+    finalize_jobs(dbpath, [(job_id, success, error_msg, attempts, max_retries, backoff_base)])
+
+
+def finalize_jobs(dbpath, outcomes):
+    """Record many outcomes and their metrics in one transaction.
+
+    Each outcome is (job_id, success, error_msg, attempts, max_retries,
+    backoff_base), i.e. finalize_job's arguments.
+    """
+    conn = get_conn(dbpath)
+    counts = {}
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for job_id, success, error_msg, attempts, max_retries, backoff_base in outcomes:
+            if success:
+                _complete(conn, job_id)
+                keys = ("jobs_processed",)
+            else:
+                _fail(conn, job_id, attempts, max_retries, error_msg, backoff_base)
+                keys = ("jobs_failed", "jobs_retried")
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+        for key, amount in counts.items():
+            exec_cached(conn, _METRIC_SQL, (key, amount))
+        conn.execute("COMMIT")
+    except Exception:
+        # after some errors (SQLITE_FULL, IOERR, ...) SQLite has already
+        # rolled back; a second ROLLBACK would mask the original error
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+_LIST_KEYS = ("id", "command", "state", "attempts", "max_retries", "created_at", "updated_at", "next_attempt_at", "last_error")
+
+
+def list_jobs_iter(dbpath, state=None):
+    """Stream jobs without materializing them.
+
+    Returns (keys, cursor); the cursor yields one plain tuple per job in the
+    order of keys.
+    """
+    cur = get_conn(dbpath).cursor()
     if state:
         cur.execute(
-            "SELECT id,command,state,attempts,max_retries,created_at,updated_at,next_attempt_at,last_error FROM jobs WHERE state=? ORDER BY created_at",
+            "SELECT " + _JOB_COLS + " FROM jobs WHERE state=? ORDER BY created_at_ms",
             (state,),
         )
     else:
         cur.execute(
-            "SELECT id,command,state,attempts,max_retries,created_at,updated_at,next_attempt_at,last_error FROM jobs ORDER BY created_at"
+            "SELECT " + _JOB_COLS + " FROM jobs ORDER BY created_at_ms"
         )
-    rows = cur.fetchall()
-    conn.close()
-    keys = ["id", "command", "state", "attempts", "max_retries", "created_at", "updated_at", "next_attempt_at", "last_error"]
-    return [dict(zip(keys, r)) for r in rows]
+    return _LIST_KEYS, cur
+
+
+_LIST_JSON = "json_object(" + ",".join(
+    f"'{k}'," + (_iso_expr(k) if k.endswith("_at") else k) for k in _LIST_KEYS
+) + ")"
+
+
+_NON_ASCII = re.compile(r"[^\x00-\x7f]")
+
+
+def _json_escape(m):
+    c = ord(m.group())
+    if c > 0xFFFF:
+        # outside the BMP: a UTF-16 surrogate pair, as json.dumps writes it
+        c -= 0x10000
+        return "\\u%04x\\u%04x" % (0xD800 | (c >> 10), 0xDC00 | (c & 0x3FF))
+    return "\\u%04x" % c
+
+
+def list_jobs_json(dbpath, state=None):
+    """Yield each job as a compact JSON object string built by SQLite itself.
+
+    SQLite leaves non-ASCII characters raw; they are \\u-escaped here (like
+    json.dumps' ensure_ascii) so the output prints on any console encoding.
+    """
+    cur = get_conn(dbpath).cursor()
+    if state:
+        cur.execute("SELECT " + _LIST_JSON + " FROM jobs WHERE state=? ORDER BY created_at_ms", (state,))
+    else:
+        cur.execute("SELECT " + _LIST_JSON + " FROM jobs ORDER BY created_at_ms")
+    for (text,) in cur:
+        yield text if text.isascii() else _NON_ASCII.sub(_json_escape, text)
+
+
+def iter_jobs(dbpath, state=None):
+    """Yield one dict per job straight off the cursor."""
+    keys, cur = list_jobs_iter(dbpath, state)
+    for r in cur:
+        yield dict(zip(keys, r))
+
+
+def list_jobs(dbpath, state=None):
+    return list(iter_jobs(dbpath, state))
 
 
 def get_stats(dbpath):
-    conn = sqlite3.connect(dbpath)
-    cur = conn.cursor()
+    cur = get_conn(dbpath).cursor()
     cur.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
     rows = cur.fetchall()
-    conn.close()
     d = {r[0]: r[1] for r in rows}
     return {"states": d}
 
 
 def set_config(dbpath, key, value):
-    conn = sqlite3.connect(dbpath)
-    cur = conn.cursor()
+    cur = get_conn(dbpath).cursor()
     cur.execute("INSERT OR REPLACE INTO config(key,value) VALUES(?,?)", (key, str(value)))
-    conn.commit()
-    conn.close()
 
 
 def get_config(dbpath, key):
-    conn = sqlite3.connect(dbpath)
-    cur = conn.cursor()
+    cur = get_conn(dbpath).cursor()
     cur.execute("SELECT value FROM config WHERE key=?", (key,))
     r = cur.fetchone()
-    conn.close()
     return r[0] if r else None
 
 
 def retry_dead_job(dbpath, job_id):
-    conn = sqlite3.connect(dbpath)
-    cur = conn.cursor()
-    now = _now_ts()
-    cur.execute("UPDATE jobs SET state='pending', attempts=0, updated_at=?, next_attempt_at=NULL, last_error=NULL WHERE id=? AND state='dead'", (now, job_id))
-    conn.commit()
-    conn.close()
+    cur = get_conn(dbpath).cursor()
+    now = _now_ms()
+    cur.execute("UPDATE jobs SET state='pending', attempts=0, updated_at_ms=?, next_attempt_at_ms=NULL, next_attempt_at=NULL, last_error=NULL WHERE id=? AND state='dead'", (now, job_id))
@@ -0,0 +1,87 @@
+"""Per-thread persistent SQLite connections for queuectl.
+
+Each thread gets one long-lived connection per database path, so worker
+loops don't pay a connect/PRAGMA/close cycle on every db call.
+"""
+import atexit
+import os
+import threading
+
+_local = threading.local()
+_all_conns = []
+_all_lock = threading.Lock()
+_generation = 0
+
+
+def _thread_conns():
+    # connections must not leak into a forked child, nor survive close_all()
+    key = (os.getpid(), _generation)
+    if getattr(_local, "key", None) != key:
+        _local.key = key
+        _local.conns = {}
+    return _local.conns
+
+
+def get_conn(dbpath):
+    """Return this thread's connection for dbpath, opening it on first use."""
+    conns = _thread_conns()
+    conn = conns.get(dbpath)
+    if conn is None:
+        from qctl import db
+
+        conn = db._open(dbpath)
+        conns[dbpath] = conn
+        with _all_lock:
+            _all_conns.append(conn)
+    return conn
+
+
+def exec_cached(conn, sql, params=()):
+    """Execute sql on a cursor kept per (connection, SQL text) and return it.
+
+    Connections from qctl.db._open carry a `_stmts` dict; any other
+    connection just gets a plain execute().
+    """
+    stmts = getattr(conn, "_stmts", None)
+    if stmts is None:
+        return conn.execute(sql, params)
+    cur = stmts.get(sql)
+    if cur is None:
+        cur = stmts[sql] = conn.cursor()
+    return cur.execute(sql, params)
+
+
+def release(dbpath=None):
+    """Close this thread's pooled connection(s); all paths if dbpath is None."""
+    conns = _thread_conns()
+    paths = list(conns) if dbpath is None else [dbpath]
+    for p in paths:
+        conn = conns.pop(p, None)
+        if conn is None:
+            continue
+        with _all_lock:
+            try:
+                _all_conns.remove(conn)
+            except ValueError:
+                pass
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def close_all():
+    """Close every pooled connection from every thread (used at exit)."""
+    global _generation
+    with _all_lock:
+        _generation += 1
+        conns = list(_all_conns)
+        del _all_conns[:]
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+atexit.register(close_all)
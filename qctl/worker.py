@@ -1,13 +1,55 @@
-"""Worker implementation: spawns worker threads to process jobs. (qctl copy)"""
+"""Worker implementation: spawns worker threads (or processes) to process jobs. (qctl copy)"""
+import collections
+import concurrent.futures
+import multiprocessing
 import os
+import queue
+import re
+import shlex
+import shutil
+import signal
 import sqlite3
+import sys
+import tempfile
 import threading
 import time
 import subprocess
+import traceback
+import weakref
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
+from qctl import _stopwatch, db_pool
+
 STOPFILE = "queue.worker.stop"
 PIDFILE = "queue.worker.pid"
+CONFIG_TTL = 30  # seconds a cached config value is trusted
+IDLE_MIN = 0.05  # first wait after an empty poll
+IDLE_MAX = 2.0  # cap for the doubling idle wait
+STOP_POLL = 0.5  # stopfile poll interval where inotify is unavailable
+CLAIM_BATCH = 8  # most jobs a worker claims in one round-trip
+CLAIM_HORIZON = 120  # seconds of (timeout-bounded) work a worker may hold claimed
+LOG_CACHE_SIZE = 32  # job log fds each worker keeps open (retries reuse them)
+FLUSH_INTERVAL = 0.05  # seconds job outcomes may wait to be written
+FLUSH_MAX = 100  # most outcomes written in one transaction
+FLUSH_RETRY_MAX = 5.0  # cap for the doubling wait between busy retries
+
+# (dbpath, key) -> (fetched_at, value)
+_cfg_cache = {}
+
+# anything that makes /bin/sh do more than split words and strip quotes
+_SHELL_CHARS = re.compile(r"[|&;<>()$`\\*?\[\]#~{}\n]")
+
+# warm interpreters for `python -c` jobs; set up by run_workers(python_pool=True)
+_py_pool = None
+_py_pool_size = 0
+_py_pool_lock = threading.Lock()
+# pools killed by a timeout restart, to tell their interrupted jobs from a crash
+_restarted_py_pools = weakref.WeakSet()
+_PY_NAMES = {"python", "python3", os.path.basename(sys.executable)}
+
+# per worker thread: OrderedDict path -> (fd, (st_dev, st_ino)), LRU order
+_log_local = threading.local()
 
 
 def _pid_path(dbpath):
@@ -20,7 +62,12 @@ def _stopfile_path(dbpath):
     return os.path.join(base, STOPFILE)
 
 
+# The stop request lives in config['stop']; the stopfile is only the wake-up
+# for the watcher thread, so nothing ever stats it in a loop.
 def clear_stopfile(dbpath):
+    from qctl import db
+
+    db.set_config(dbpath, "stop", "0")
     p = _stopfile_path(dbpath)
     try:
         if os.path.exists(p):
@@ -30,13 +77,25 @@ def clear_stopfile(dbpath):
 
 
 def request_stop(dbpath):
+    from qctl import db
+
+    db.set_config(dbpath, "stop", "1")
     p = _stopfile_path(dbpath)
     with open(p, "w"):
         pass
 
 
 def is_stop_requested(dbpath):
-    return os.path.exists(_stopfile_path(dbpath))
+    from qctl import db
+
+    return db.get_config(dbpath, "stop") == "1"
+
+
+def _watch_stopfile(dbpath, stop_event):
+    """Set stop_event once the stopfile appears, so workers only check the event."""
+    if _stopwatch.wait_for_file(_stopfile_path(dbpath), stop_event, STOP_POLL):
+        print("Stop requested via CLI")
+        stop_event.set()
 
 
 def _write_pid(dbpath):
@@ -52,153 +111,656 @@ def _remove_pid(dbpath):
         pass
 
 
-def run_workers(dbpath, count=1, base=2, default_timeout=30, logs_dir=None):
-    """Run worker threads in foreground. Blocks until stop requested."""
+def _direct_argv(cmd):
+    """argv to exec cmd without a shell, or None if it needs one."""
+    if os.name != "posix" or _SHELL_CHARS.search(cmd):
+        return None
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        return None
+    # env assignments and builtins (cd, export, ...) only work in a shell;
+    # missing binaries also go through it so the job fails with exit 127
+    if not argv or "=" in argv[0] or shutil.which(argv[0]) is None:
+        return None
+    return argv
+
+
+def _python_code(cmd):
+    """(code, argv) if cmd is `python -c CODE [ARGS...]`, else None."""
+    try:
+        argv = shlex.split(cmd, posix=os.name == "posix")
+    except ValueError:
+        return None
+    if len(argv) < 3 or argv[1] != "-c":
+        return None
+    exe = os.path.basename(argv[0])
+    if exe.lower().endswith(".exe"):
+        exe = exe[:-4]
+    if exe not in _PY_NAMES:
+        return None
+    code = argv[2]
+    if os.name != "posix" and len(code) > 1 and code[0] == code[-1] == '"':
+        code = code[1:-1]
+    return code, argv[3:]
+
+
+def _exec_pycode(code, args):
+    """Pool task: run code like `python -c`, returning (returncode, stdout, stderr).
+
+    fds 1 and 2 point at temp files while it runs, so output from child
+    processes and C code lands in the job log too, as with a subprocess.
+    """
+    files = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+    _flush_std()
+    saved_fds = [os.dup(1), os.dup(2)]
+    saved_streams = sys.stdout, sys.stderr
+    saved_argv = sys.argv
+    sys.argv = ["-c"] + list(args)
+    rc = 0
+    try:
+        os.dup2(files[0].fileno(), 1)
+        os.dup2(files[1].fileno(), 2)
+        try:
+            exec(compile(code, "<string>", "exec"), {"__name__": "__main__"})
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                rc = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                rc = 1
+        except BaseException as e:
+            # drop this frame so the traceback looks like `python -c`'s
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            rc = 1
+        _flush_std()
+    finally:
+        sys.stdout, sys.stderr = saved_streams
+        sys.argv = saved_argv
+        for fd, saved in zip((1, 2), saved_fds):
+            os.dup2(saved, fd)
+            os.close(saved)
+    out, err = (_read_back(f) for f in files)
+    return rc, out, err
+
+
+def _read_back(f):
+    with f:
+        f.seek(0)
+        return f.read().decode("utf-8", "replace")
+
+
+def _flush_std():
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except Exception:
+            pass  # None, closed by the job, ...
+
+
+def _py_pool_context():
+    # never fork: by the time the pool (re)starts, this process runs worker,
+    # dispatcher, flusher and watcher threads whose held locks a forked child
+    # would inherit. forkserver children come from a clean single-threaded
+    # server; spawn is the fallback where forkserver doesn't exist.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class _PoolInterrupted(Exception):
+    """A pooled job was cut short by a pool restart another job caused."""
+
+
+def _new_py_pool(size):
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=size, mp_context=_py_pool_context())
+    # start every interpreter now rather than on the first jobs: each submit
+    # with no idle interpreter launches another, up to size
+    concurrent.futures.wait([pool.submit(int) for _ in range(size)])
+    return pool
+
+
+def _start_py_pool(size):
+    global _py_pool, _py_pool_size
+    pool = _new_py_pool(size)
+    with _py_pool_lock:
+        _py_pool_size = size
+        _py_pool = pool
+
+
+def _stop_py_pool():
+    """Shut the pool down once its running jobs finish."""
+    global _py_pool
+    with _py_pool_lock:
+        pool, _py_pool = _py_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def _kill_py_pool(pool):
+    """Terminate every interpreter in pool, busy or not."""
+    for p in list((getattr(pool, "_processes", None) or {}).values()):
+        try:
+            p.terminate()
+        except Exception:
+            pass
+    pool.shutdown(wait=False)
+
+
+def _replace_py_pool(pool, healthy=False):
+    """Kill pool and start a fresh one in its place, unless that already happened.
+
+    Serialized under _py_pool_lock: when several jobs time out (or lose their
+    interpreter) together, only the first replaces the pool they all ran in,
+    and none of them kills the pool that replaced it. healthy=True (a
+    timeout, not a crash) records the pool in _restarted_py_pools so the
+    other jobs it was running know they were merely interrupted.
+    """
+    global _py_pool
+    with _py_pool_lock:
+        if pool is not _py_pool:
+            return
+        if healthy:
+            _restarted_py_pools.add(pool)
+        _kill_py_pool(pool)
+        _py_pool = _new_py_pool(_py_pool_size)
+
+
+def _run_in_py_pool(code, args, job_timeout):
+    """Run a python job in the warm pool; None if the pool can't take it."""
+    pool = _py_pool
+    if pool is None:
+        return None
+    try:
+        fut = pool.submit(_exec_pycode, code, args)
+    except (BrokenProcessPool, RuntimeError):
+        # pool already torn down (another job's timeout, shutdown); this job
+        # hasn't started, so it can safely run as a plain subprocess instead
+        return None
+    try:
+        return fut.result(timeout=job_timeout)
+    except concurrent.futures.TimeoutError:
+        # the interpreter is still busy with this job: replace the pool
+        _replace_py_pool(pool, healthy=True)
+        raise subprocess.TimeoutExpired(code, job_timeout)
+    except BrokenProcessPool as e:
+        if pool in _restarted_py_pools:
+            # another job's timeout killed the pool, possibly midway through
+            # this one; not this job's fault, so it mustn't cost an attempt
+            raise _PoolInterrupted() from e
+        # an interpreter exited or crashed (os._exit, segfault, ...) and took
+        # the pool with it; replace it so later jobs can still use one
+        _replace_py_pool(pool)
+        raise RuntimeError("a pooled python interpreter died while the job was running") from e
+
+
+def _run_command(cmd, job_timeout, log_fd):
+    """Run a job command; returns (returncode, stderr). Raises TimeoutExpired.
+
+    stdout goes straight into the job log; stderr is returned so it can also
+    feed last_error.
+    """
+    py = _python_code(cmd) if _py_pool is not None else None
+    if py is not None:
+        res = _run_in_py_pool(py[0], py[1], job_timeout)
+        if res is not None:
+            rc, out, err = res
+            if out:
+                _log_write(log_fd, out)
+            return rc, err
+    argv = _direct_argv(cmd)
+    # use a shell only when the command needs one
+    proc = subprocess.run(
+        argv or cmd,
+        shell=argv is None,
+        stdout=subprocess.DEVNULL if log_fd is None else log_fd,
+        stderr=subprocess.PIPE,
+        text=True,
+        timeout=job_timeout,
+    )
+    return proc.returncode, proc.stderr or ""
+
+
+def _get_log_fd(path):
+    """Append-mode fd for a job log, kept open in this worker's LRU cache.
+
+    A cached fd is reused only while path still names the same file, so a
+    rotated or deleted log gets reopened.
+    """
+    cache = getattr(_log_local, "fds", None)
+    if cache is None:
+        cache = _log_local.fds = collections.OrderedDict()
+    entry = cache.pop(path, None)
+    if entry is not None:
+        fd, ident = entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is not None and (st.st_dev, st.st_ino) == ident:
+            cache[path] = entry
+            return fd
+        os.close(fd)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_CLOEXEC", 0), 0o644)
+    st = os.fstat(fd)
+    cache[path] = (fd, (st.st_dev, st.st_ino))
+    if len(cache) > LOG_CACHE_SIZE:
+        _, (old_fd, _) = cache.popitem(last=False)
+        os.close(old_fd)
+    return fd
+
+
+def _close_log_fds():
+    cache = getattr(_log_local, "fds", None) or {}
+    for fd, _ in cache.values():
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    _log_local.fds = None
+
+
+def _log_write(fd, text):
+    if fd is None:
+        return
+    try:
+        os.write(fd, text.encode("utf-8", "replace"))
+    except OSError:
+        pass
+
+
+def _get_backoff_base(dbpath, default):
+    """Return config backoff_base, re-reading it at most every CONFIG_TTL seconds."""
+    now = time.monotonic()
+    cached = _cfg_cache.get((dbpath, "backoff_base"))
+    if cached is not None and now - cached[0] < CONFIG_TTL:
+        return cached[1]
     from qctl import db
 
-    # ensure db exists
-    db.init_db(dbpath)
+    value = int(db.get_config(dbpath, "backoff_base") or default)
+    _cfg_cache[(dbpath, "backoff_base")] = (now, value)
+    return value
 
-    clear_stopfile(dbpath)
-    _write_pid(dbpath)
-    stop_event = threading.Event()
 
-    def _worker_loop(idx):
-        print(f"Worker-{idx} started")
-        while not stop_event.is_set() and not is_stop_requested(dbpath):
+def _is_busy(e):
+    """True if an OperationalError is SQLITE_BUSY/SQLITE_LOCKED (worth retrying)."""
+    code = getattr(e, "sqlite_errorcode", None)
+    if code is None:
+        # raised by hand rather than by SQLite: go by the message
+        return "locked" in str(e) or "busy" in str(e)
+    # extended codes (SQLITE_BUSY_SNAPSHOT, ...) keep the primary code in the low byte
+    return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+
+class CompletionFlusher(threading.Thread):
+    """Writes job outcomes in batches instead of one transaction per job.
+
+    Workers submit() finalize_job-style tuples; the flusher commits whatever
+    arrived within FLUSH_INTERVAL of the first one (at most FLUSH_MAX) via
+    db.finalize_jobs. If that fails, the batch is written one outcome at a
+    time, retrying busy/locked errors until it lands. stop() writes anything still
+    queued and waits.
+    """
+
+    def __init__(self, dbpath):
+        super().__init__(name="qctl-flusher", daemon=True)
+        self.dbpath = dbpath
+        self._items = queue.SimpleQueue()
+
+    def submit(self, outcome):
+        self._items.put(outcome)
+
+    def stop(self):
+        self._items.put(None)
+        self.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self._items.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < FLUSH_MAX:
+                try:
+                    item = self._items.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+        db_pool.release(self.dbpath)
+
+    def _write(self, batch):
+        from qctl import db
+
+        try:
+            db.finalize_jobs(self.dbpath, batch)
+            return
+        except Exception as e:
+            print(f"Batched outcome write failed ({e!r}); writing job by job")
+        # one at a time, so a single bad outcome can't sink the rest
+        for outcome in batch:
+            self._write_one(db, outcome)
+
+    def _write_one(self, db, outcome):
+        delay = FLUSH_INTERVAL
+        while True:
+            try:
+                db.finalize_job(self.dbpath, *outcome)
+                return
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e):
+                    # read-only, disk full, I/O error, ...: retrying would
+                    # only hang stop(); the job stays processing
+                    print(f"Cannot record outcome {outcome!r}, job {outcome[0]!r} stays processing:", e)
+                    return
+                # busy/locked is transient: keep the outcome and retry, since
+                # a job whose outcome is never written stays processing
+                print(f"DB busy, retrying outcome of job {outcome[0]!r}:", e)
+            except Exception:
+                # retrying won't help (corrupt page, malformed outcome, ...)
+                print(f"Cannot record outcome {outcome!r}:")
+                traceback.print_exc()
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, FLUSH_RETRY_MAX)
+
+
+def _process_job(dbpath, job, idx, base, default_timeout, logs_dir, flusher):
+    """Run one claimed job and hand its outcome to the flusher."""
+    jid = job["id"]
+    cmd = job["command"]
+    attempts = job.get("attempts", 0)
+    max_retries = job.get("max_retries", 3)
+    job_timeout = job.get("timeout") or default_timeout
+    # the claim already stored logs_dir/<id>.log for jobs without a log_path
+    job_log = job.get("log_path") or os.path.join(logs_dir, f"{jid}.log")
+    print(f"Worker-{idx} picked job {jid} (attempts={attempts}) -> {cmd}")
+    try:
+        log_fd = _get_log_fd(job_log)
+    except OSError:
+        log_fd = None
+    _log_write(log_fd, f"--- RUN {datetime.utcnow().isoformat()}Z ---\n")
+    # Execute command
+    try:
+        returncode, stderr = _run_command(cmd, job_timeout, log_fd)
+        if stderr:
+            _log_write(log_fd, "STDERR:\n" + stderr + "\n")
+
+        if returncode == 0:
+            flusher.submit((jid, True, None, attempts, max_retries, base))
+            print(f"Job {jid} completed")
+        else:
+            err = f"Exit {returncode}: {stderr.strip()[:200]}"
+            flusher.submit((jid, False, err, attempts, max_retries, _get_backoff_base(dbpath, base)))
+            print(f"Job {jid} failed: {err}")
+    except subprocess.TimeoutExpired as e:
+        err = f"Timeout after {job_timeout}s"
+        # write partial stderr if any (stdout is already in the log)
+        if e.stderr:
+            partial = e.stderr if isinstance(e.stderr, str) else e.stderr.decode("utf-8", "replace")
+            _log_write(log_fd, "STDERR:\n" + partial + "\n")
+        flusher.submit((jid, False, err, attempts, max_retries, _get_backoff_base(dbpath, base)))
+        print(f"Job {jid} timed out")
+    except _PoolInterrupted:
+        # back to pending with attempts unchanged; it runs again from the start
+        _log_write(log_fd, "--- INTERRUPTED by a python pool restart, released ---\n")
+        from qctl import db
+
+        try:
+            db.release_jobs(dbpath, [jid])
+        except sqlite3.Error as e:
+            print(f"Cannot release job {jid}, it stays processing:", e)
+            return
+        print(f"Job {jid} interrupted by a python pool restart; released")
+    except Exception as e:
+        err = str(e)
+        flusher.submit((jid, False, err, attempts, max_retries, _get_backoff_base(dbpath, base)))
+        print(f"Job {jid} raised: {err}")
+
+
+def _worker_loop(idx, dbpath, stop_event, base, default_timeout, logs_dir, batch, flusher):
+    from qctl import db
+
+    print(f"Worker-{idx} started")
+    worker_id = f"{os.getpid()}-{idx}"
+    idle = IDLE_MIN
+    claimed = collections.deque()
+    while not stop_event.is_set():
+        if not claimed:
             try:
-                job = db.fetch_and_lock_job(dbpath)
+                claimed.extend(db.fetch_and_lock_batch(dbpath, limit=batch, logs_dir=logs_dir, worker_id=worker_id))
             except sqlite3.OperationalError as e:
                 print("DB busy, sleeping", e)
-                time.sleep(0.5)
+                stop_event.wait(0.5)
                 continue
-            if not job:
-                time.sleep(0.5)
-                continue
-            jid = job["id"]
-            cmd = job["command"]
-            attempts = job.get("attempts", 0)
-            max_retries = job.get("max_retries", 3)
-            job_timeout = job.get("timeout") or default_timeout
-            job_log = job.get("log_path")
-            if not job_log:
-                # default log path
-                logs_dir_local = logs_dir
-                if logs_dir_local is None:
-                    logs_dir_local = os.path.join(os.path.dirname(dbpath), "logs")
-                try:
-                    os.makedirs(logs_dir_local, exist_ok=True)
-                except Exception:
-                    pass
-                job_log = os.path.join(logs_dir_local, f"{jid}.log")
-                # persist log_path
-                try:
-                    conn = sqlite3.connect(dbpath)
-                    conn.execute("UPDATE jobs SET log_path=? WHERE id=?", (job_log, jid))
-                    conn.commit()
-                    conn.close()
-                except Exception:
-                    pass
-            print(f"Worker-{idx} picked job {jid} (attempts={attempts}) -> {cmd}")
-            # Execute command
-            try:
-                # run in shell so typical shell commands are available
-                # capture output and enforce timeout
-                proc = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=job_timeout)
-                stdout = proc.stdout or ""
-                stderr = proc.stderr or ""
-                # write logs
-                try:
-                    with open(job_log, "a", encoding="utf-8") as f:
-                        f.write(f"--- RUN {datetime.utcnow().isoformat()}Z ---\n")
-                        if stdout:
-                            f.write("STDOUT:\n")
-                            f.write(stdout)
-                            f.write("\n")
-                        if stderr:
-                            f.write("STDERR:\n")
-                            f.write(stderr)
-                            f.write("\n")
-                except Exception:
-                    pass
-
-                if proc.returncode == 0:
-                    db.complete_job(dbpath, jid)
-                    _inc_metric(dbpath, 'jobs_processed', 1)
-                    print(f"Job {jid} completed")
-                else:
-                    err = f"Exit {proc.returncode}: {stderr.strip()[:200]}"
-                    backoff_base = int(db.get_config(dbpath, "backoff_base") or base)
-                    db.fail_job(dbpath, jid, attempts, max_retries, err, backoff_base=backoff_base)
-                    _inc_metric(dbpath, 'jobs_failed', 1)
-                    _inc_metric(dbpath, 'jobs_retried', 1)
-                    print(f"Job {jid} failed: {err}")
-            except subprocess.TimeoutExpired as e:
-                err = f"Timeout after {job_timeout}s"
-                # write partial output if any
-                try:
-                    with open(job_log, "a", encoding="utf-8") as f:
-                        if e.stdout:
-                            f.write("STDOUT:\n")
-                            f.write(e.stdout)
-                        if e.stderr:
-                            f.write("STDERR:\n")
-                            f.write(e.stderr)
-                        f.write("\n")
-                except Exception:
-                    pass
-                backoff_base = int(db.get_config(dbpath, "backoff_base") or base)
-                db.fail_job(dbpath, jid, attempts, max_retries, err, backoff_base=backoff_base)
-                _inc_metric(dbpath, 'jobs_failed', 1)
-                _inc_metric(dbpath, 'jobs_retried', 1)
-                print(f"Job {jid} timed out")
-            except Exception as e:
-                err = str(e)
-                backoff_base = int(db.get_config(dbpath, "backoff_base") or base)
-                db.fail_job(dbpath, jid, attempts, max_retries, err, backoff_base=backoff_base)
-                _inc_metric(dbpath, 'jobs_failed', 1)
-                _inc_metric(dbpath, 'jobs_retried', 1)
-                print(f"Job {jid} raised: {err}")
-
-        print(f"Worker-{idx} exiting")
-
-    threads = []
-    for i in range(count):
-        t = threading.Thread(target=_worker_loop, args=(i + 1,), daemon=True)
-        threads.append(t)
-        t.start()
+        if not claimed:
+            # back off while the queue stays empty; wakes early on stop
+            stop_event.wait(idle)
+            idle = min(idle * 2, IDLE_MAX)
+            continue
+        idle = IDLE_MIN
+        _process_job(dbpath, claimed.popleft(), idx, base, default_timeout, logs_dir, flusher)
+
+    if claimed:
+        # hand back jobs we claimed but never started
+        db.release_jobs(dbpath, [j["id"] for j in claimed])
+    _close_log_fds()
+    db_pool.release(dbpath)
+    print(f"Worker-{idx} exiting")
+
 
+def _dispatch_loop(dbpath, stop_event, jobs, slots, capacity, logs_dir):
+    """Claim jobs for the pool threads (thread mode's only DB claimer).
+
+    `slots` counts jobs that may still be claimed: one is taken per claimed
+    job and given back when a pool thread finishes it, so at most `capacity`
+    jobs are ever claimed but unfinished. Claimed jobs carry worker_id
+    '<pid>-dispatch' until a pool thread picks them up.
+    """
     try:
-        # wait until stop requested
-        while True:
-            if is_stop_requested(dbpath):
-                print("Stop requested via CLI")
-                break
-            time.sleep(0.5)
-    finally:
+        _dispatch(dbpath, stop_event, jobs, slots, capacity, logs_dir)
+    except Exception:
+        # nothing would claim jobs any more; take the whole run down with it
+        print("Dispatcher failed, stopping workers:")
+        traceback.print_exc()
         stop_event.set()
-        # allow threads to finish
-        for t in threads:
-            t.join()
-        _remove_pid(dbpath)
-        # clean stopfile
+    finally:
+        db_pool.release(dbpath)
+
+
+def _dispatch(dbpath, stop_event, jobs, slots, capacity, logs_dir):
+    from qctl import db
+
+    worker_id = f"{os.getpid()}-dispatch"
+    idle = IDLE_MIN
+    while not stop_event.is_set():
+        # wait for a free slot; the timeout keeps stop responsive
+        if not slots.acquire(timeout=STOP_POLL):
+            continue
+        free = 1
+        while free < capacity and slots.acquire(blocking=False):
+            free += 1
         try:
-            os.remove(_stopfile_path(dbpath))
-        except Exception:
-            pass
+            claimed = db.fetch_and_lock_batch(dbpath, limit=free, logs_dir=logs_dir, worker_id=worker_id)
+        except sqlite3.Error as e:
+            print("DB error while claiming, backing off:", e)
+            claimed = []
+        for _ in range(free - len(claimed)):
+            slots.release()
+        for job in claimed:
+            jobs.put(job)
+        if claimed:
+            idle = IDLE_MIN
+        else:
+            # back off while the queue stays empty; wakes early on stop
+            stop_event.wait(idle)
+            idle = min(idle * 2, IDLE_MAX)
+
+
+def _pool_worker(idx, dbpath, jobs, slots, base, default_timeout, logs_dir, flusher):
+    """Run jobs handed over by the dispatcher until a None sentinel arrives."""
+    from qctl import db
+
+    print(f"Worker-{idx} started")
+    worker_id = f"{os.getpid()}-{idx}"
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        try:
+            try:
+                db.assign_job(dbpath, job["id"], worker_id)
+            except sqlite3.Error as e:
+                # bookkeeping only; run the job regardless
+                print(f"Could not record worker for job {job['id']}:", e)
+            _process_job(dbpath, job, idx, base, default_timeout, logs_dir, flusher)
+        finally:
+            slots.release()
+    _close_log_fds()
+    db_pool.release(dbpath)
+    print(f"Worker-{idx} exiting")
+
+
+def _stop_pool_workers(dbpath, jobs, count):
+    """Hand back jobs no pool thread has started, then stop the threads."""
+    from qctl import db
+
+    unstarted = []
+    while True:
+        try:
+            job = jobs.get_nowait()
+        except queue.Empty:
+            break
+        unstarted.append(job["id"])
+    if unstarted:
+        db.release_jobs(dbpath, unstarted)
+    for _ in range(count):
+        jobs.put(None)
 
 
-def _inc_metric(dbpath, key, amount=1):
+def _worker_process(idx, dbpath, stop_event, base, default_timeout, logs_dir, batch, python_pool):
+    """Entry point of a worker process (run_workers(processes=True))."""
+    # Ctrl-C is handled by the parent, which sets stop_event for everyone
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if python_pool:
+        _start_py_pool(1)
+    flusher = CompletionFlusher(dbpath)
+    flusher.start()
     try:
-        conn = sqlite3.connect(dbpath)
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM metrics WHERE key=?", (key,))
-        r = cur.fetchone()
-        if r:
-            cur.execute("UPDATE metrics SET value = value + ? WHERE key=?", (amount, key))
-        else:
-            cur.execute("INSERT INTO metrics(key, value) VALUES(?,?)", (key, amount))
-        conn.commit()
-        conn.close()
+        _worker_loop(idx, dbpath, stop_event, base, default_timeout, logs_dir, batch, flusher)
+    finally:
+        flusher.stop()
+        _stop_py_pool()
+        sys.stdout.flush()
+
+
+def run_workers(dbpath, count=1, base=2, default_timeout=30, logs_dir=None, python_pool=False, processes=False, on_ready=None):
+    """Run workers in foreground. Blocks until stop requested.
+
+    Workers are threads by default: one dispatcher thread claims jobs in
+    batches and hands them to `count` pool threads over an in-memory queue.
+    processes=True instead runs each worker in its own process (own
+    interpreter, own SQLite connection, own claims) to sidestep the GIL.
+    With python_pool=True, `python -c "..."` jobs run in persistent pooled
+    interpreters instead of a fresh process each. on_ready, if given, is
+    called once setup is done, just before the workers start; a stop
+    requested from then on is still seen.
+    """
+    from qctl import db
+
+    # ensure db exists
+    db.init_db(dbpath)
+
+    clear_stopfile(dbpath)
+    _write_pid(dbpath)
+    if logs_dir is None:
+        logs_dir = os.path.join(os.path.dirname(dbpath), "logs")
+    try:
+        os.makedirs(logs_dir, exist_ok=True)
     except Exception:
         pass
+    # don't let one worker sit on more work than it can start soon
+    batch = max(1, min(CLAIM_BATCH, CLAIM_HORIZON // max(1, default_timeout)))
+
+    dispatcher = flusher = None
+    if processes:
+        stop_event = multiprocessing.Event()
+        workers = [
+            multiprocessing.Process(
+                target=_worker_process,
+                args=(i + 1, dbpath, stop_event, base, default_timeout, logs_dir, batch, python_pool),
+            )
+            for i in range(count)
+        ]
+        # children get their own connections; don't hand them ours
+        db_pool.release(dbpath)
+    else:
+        stop_event = threading.Event()
+        if python_pool:
+            _start_py_pool(count)
+        jobs = queue.SimpleQueue()
+        # each pool thread gets at most one job queued behind its running one
+        # (none when timeouts are long enough that CLAIM_HORIZON says so)
+        capacity = count * min(2, batch)
+        slots = threading.Semaphore(capacity)
+        flusher = CompletionFlusher(dbpath)
+        workers = [
+            threading.Thread(
+                target=_pool_worker,
+                args=(i + 1, dbpath, jobs, slots, base, default_timeout, logs_dir, flusher),
+                daemon=True,
+            )
+            for i in range(count)
+        ]
+        dispatcher = threading.Thread(
+            target=_dispatch_loop,
+            args=(dbpath, stop_event, jobs, slots, capacity, logs_dir),
+            daemon=True,
+        )
+
+    # before anything that prints, so the signal gets a line to itself
+    if on_ready is not None:
+        on_ready()
+
+    # start workers before any helper thread, so a fork() never copies a
+    # lock held by another thread
+    for w in workers:
+        w.start()
+    if dispatcher is not None:
+        flusher.start()
+        dispatcher.start()
+
+    watcher = threading.Thread(target=_watch_stopfile, args=(dbpath, stop_event), daemon=True)
+    watcher.start()
+
+    try:
+        # wait until the watcher sees the stopfile (timeout keeps Ctrl-C responsive)
+        while not stop_event.wait(0.5):
+            pass
+    finally:
+        stop_event.set()
+        if dispatcher is not None:
+            dispatcher.join()
+            _stop_pool_workers(dbpath, jobs, count)
+        # allow workers to finish
+        for w in workers:
+            w.join()
+        if flusher is not None:
+            flusher.stop()
+        _stop_py_pool()
+        # fold the WAL back into the db so an idle queue leaves no large -wal
+        try:
+            db_pool.get_conn(dbpath).execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error:
+            pass
+        _remove_pid(dbpath)
+        # clean stop flag and stopfile
+        try:
+            clear_stopfile(dbpath)
+        except sqlite3.Error:
+            pass
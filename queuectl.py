@@ -6,40 +6,127 @@ Run with: python queuectl.py <command>
 
 This file contains the CLI entrypoint and command wiring.
 """
-import argparse
 import json
 import os
+import sqlite3
 import sys
-from datetime import datetime
 
-from qctl import db, worker
+# argparse and qctl.worker (multiprocessing, concurrent.futures)
+# are imported where used so the common enqueue/list/status calls skip them
+from qctl import db
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "queue.db")
+try:
+    # optional: faster JSON parsing; the stdlib json module is the fallback
+    import orjson
+except ImportError:
+    orjson = None
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+# QCTL_DB points the CLI at another database; the worker's pid/stop files
+# and job logs live next to whichever file is used
+DB_PATH = os.environ.get("QCTL_DB") or os.path.join(os.path.dirname(__file__), "queue.db")
+
+
+_ready = None
 
 
 def ensure_db():
-    db.init_db(DB_PATH)
+    """Return the pooled connection for DB_PATH, creating/migrating the schema once."""
+    global _ready
+    if _ready != DB_PATH:
+        # init_db opens the pooled connection that every later db.* call
+        # in this process reuses
+        try:
+            db.init_db(DB_PATH)
+        except sqlite3.OperationalError:
+            raise  # locked/busy etc.: the file itself is fine
+        except sqlite3.DatabaseError as e:
+            # a corrupt file can't hold its own setting, hence the env var
+            if os.environ.get("QCTL_CORRUPTED_BEHAVIOR", "FATAL").upper() != "DELETE":
+                raise
+            aside = _move_aside(DB_PATH)
+            print(f"{DB_PATH} is unreadable ({e}); moved it to {aside} and starting empty", file=sys.stderr)
+            db.init_db(DB_PATH)
+        _ready = DB_PATH
+    return db.get_conn(DB_PATH)
+
+
+def _move_aside(path):
+    """Rename path (and its -wal/-shm files) to path.corrupt-<ms>; return the new name."""
+    from qctl import db_pool
+
+    db_pool.release(path)
+    aside = f"{path}.corrupt-{db._now_ms()}"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.replace(path + suffix, aside + suffix)
+    return aside
+
+
+def _apply_defaults(job, now):
+    job.setdefault("state", "pending")
+    job.setdefault("attempts", 0)
+    job.setdefault("max_retries", 3)
+    job.setdefault("created_at", now)
+    job.setdefault("updated_at", now)
 
 
 def cmd_enqueue(args):
     ensure_db()
     raw = args.job
     try:
-        job = json.loads(raw)
+        job = _loads(raw)
     except Exception as e:
         print(f"Invalid JSON: {e}")
         return 2
+    if not isinstance(job, dict):
+        print("Invalid JSON: expected a job object")
+        return 2
 
-    now = datetime.utcnow().isoformat() + "Z"
-    job.setdefault("state", "pending")
-    job.setdefault("attempts", 0)
-    job.setdefault("max_retries", 3)
-    job.setdefault("created_at", now)
-    job.setdefault("updated_at", now)
+    _apply_defaults(job, db._now_ms())
 
     try:
         db.enqueue_job(DB_PATH, job)
         print(f"Enqueued job {job.get('id')}")
+    except db.DuplicateJobError:
+        print(f"Job {job.get('id')} is already enqueued")
+        return 1
+    except Exception as e:
+        print(f"Failed to enqueue: {e}")
+        return 1
+
+
+def _read_jobs(f):
+    """Jobs from a JSON array or NDJSON (one job object per line)."""
+    text = f.read()
+    if text.lstrip().startswith("["):
+        return _loads(text)
+    return [_loads(line) for line in text.splitlines() if line.strip()]
+
+
+def cmd_enqueue_batch(args):
+    ensure_db()
+    try:
+        if args.file == "-":
+            jobs = _read_jobs(sys.stdin)
+        else:
+            with open(args.file, encoding="utf-8") as f:
+                jobs = _read_jobs(f)
+    except Exception as e:
+        print(f"Invalid JSON: {e}")
+        return 2
+    if not isinstance(jobs, list) or not all(isinstance(job, dict) for job in jobs):
+        print("Invalid JSON: expected an array of job objects, or one job object per line")
+        return 2
+
+    now = db._now_ms()
+    for job in jobs:
+        _apply_defaults(job, now)
+
+    try:
+        n = db.enqueue_jobs(DB_PATH, jobs)
+        print(f"Enqueued {n} jobs")
     except Exception as e:
         print(f"Failed to enqueue: {e}")
         return 1
@@ -48,41 +135,74 @@ def cmd_enqueue(args):
 def cmd_worker_start(args):
     ensure_db()
     # Remove any existing stop file
+    from qctl import worker
+
     worker.clear_stopfile(DB_PATH)
-    print(f"Starting workers (count={args.count}) - Ctrl-C or 'queuectl worker stop' to stop")
+
+    def ready():
+        # READY / STOPPED lines let scripts (and the tests) wait on the
+        # worker instead of sleeping; READY is the first line, printed
+        # before any worker can write
+        print("READY", flush=True)
+        print(f"Starting workers (count={args.count}) - Ctrl-C or 'queuectl worker stop' to stop", flush=True)
+
     try:
-        worker.run_workers(DB_PATH, count=args.count, base=args.backoff_base)
+        worker.run_workers(
+            DB_PATH,
+            count=args.count,
+            base=args.backoff_base,
+            python_pool=args.python_pool,
+            processes=args.processes,
+            on_ready=ready,
+        )
     except KeyboardInterrupt:
         print("Interrupted - shutting down workers")
+        return 130
+    # only after a graceful stop, once every worker has exited
+    print("STOPPED", flush=True)
 
 
 def cmd_worker_stop(args):
+    from qctl import worker
+
     ensure_db()
     worker.request_stop(DB_PATH)
     print("Stop requested. Workers will exit after finishing current jobs.")
 
 
-def cmd_status(args):
+def get_stats_dict():
+    """Job count per state, e.g. {"pending": 2, "completed": 5}."""
     ensure_db()
-    stats = db.get_stats(DB_PATH)
+    return db.get_stats(DB_PATH)["states"]
+
+
+def cmd_status(args):
+    states = get_stats_dict()
     print("Job states:")
-    for k, v in stats.get("states", {}).items():
+    for k, v in states.items():
         print(f"  {k}: {v}")
-    print(f"Active workers (stopfile present? {worker.is_stop_requested(DB_PATH)})")
+    # same check as worker.is_stop_requested, without importing the worker module
+    print(f"Active workers (stop requested? {db.get_config(DB_PATH, 'stop') == '1'})")
+
+
+def _print_jobs(state):
+    # SQLite renders each row as compact JSON, so no dicts are built here;
+    # stdout flushes once at the end (or as its buffer fills)
+    write = sys.stdout.write
+    for text in db.list_jobs_json(DB_PATH, state=state):
+        write(text)
+        write("\n")
+    sys.stdout.flush()
 
 
 def cmd_list(args):
     ensure_db()
-    rows = db.list_jobs(DB_PATH, state=args.state)
-    for r in rows:
-        print(json.dumps(r, default=str))
+    _print_jobs(args.state)
 
 
 def cmd_dlq_list(args):
     ensure_db()
-    rows = db.list_jobs(DB_PATH, state="dead")
-    for r in rows:
-        print(json.dumps(r, default=str))
+    _print_jobs("dead")
 
 
 def cmd_dlq_retry(args):
@@ -103,7 +223,12 @@ def cmd_config_get(args):
     print(val)
 
 
+_STATES = ["pending", "processing", "completed", "failed", "dead"]
+
+
 def build_parser():
+    import argparse
+
     p = argparse.ArgumentParser(prog="queuectl")
     sp = p.add_subparsers(dest="cmd")
 
@@ -112,6 +237,11 @@ def build_parser():
     en.add_argument("job", help='Job JSON e.g. "{\"id\":\"job1\",\"command\":\"sleep 2\"}"')
     en.set_defaults(func=cmd_enqueue)
 
+    # enqueue-batch
+    eb = sp.add_parser("enqueue-batch", help="Enqueue many jobs (JSON array or NDJSON) in one transaction")
+    eb.add_argument("--file", default="-", help="Input file, or - for stdin (default)")
+    eb.set_defaults(func=cmd_enqueue_batch)
+
     # worker
     w = sp.add_parser("worker", help="Worker management")
     wsp = w.add_subparsers(dest="sub")
@@ -119,6 +249,8 @@ def build_parser():
     wstart = wsp.add_parser("start", help="Start worker(s)")
     wstart.add_argument("--count", type=int, default=1, help="Number of concurrent worker threads")
     wstart.add_argument("--backoff-base", type=int, default=2, help="Exponential backoff base")
+    wstart.add_argument("--processes", action="store_true", help="Run each worker in its own process instead of a thread")
+    wstart.add_argument("--python-pool", action="store_true", help='Run `python -c "..."` jobs in warm pooled interpreters')
     wstart.set_defaults(func=cmd_worker_start)
 
     wstop = wsp.add_parser("stop", help="Request workers to stop gracefully")
@@ -130,7 +262,7 @@ def build_parser():
 
     # list
     l = sp.add_parser("list", help="List jobs by state")
-    l.add_argument("--state", choices=["pending", "processing", "completed", "failed", "dead"], help="Filter by state")
+    l.add_argument("--state", choices=_STATES, help="Filter by state")
     l.set_defaults(func=cmd_list)
 
     # dlq
@@ -145,7 +277,12 @@ def build_parser():
     # config
     c = sp.add_parser("config", help="Configuration management")
     csp = c.add_subparsers(dest="sub")
-    cs = csp.add_parser("set", help="Set config key")
+    cs = csp.add_parser(
+        "set",
+        help="Set config key",
+        description="Keys: backoff_base N; synchronous OFF|NORMAL|FULL and journal_mode WAL|MEMORY "
+        "(trade durability for speed; take effect on newly opened connections, e.g. after a worker restart).",
+    )
     cs.add_argument("key")
     cs.add_argument("value")
     cs.set_defaults(func=cmd_config_set)
@@ -156,9 +293,38 @@ def build_parser():
     return p
 
 
+class _Args:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+def _fast_args(argv):
+    """Args for the plain forms of enqueue/list/status, else None.
+
+    Anything else (--help, other options, worker/dlq/config, bad input)
+    goes through build_parser so usage and errors are unchanged.
+    """
+    if argv[:1] == ["enqueue"] and len(argv) == 2 and not argv[1].startswith("-"):
+        return _Args(func=cmd_enqueue, job=argv[1])
+    if argv == ["status"]:
+        return _Args(func=cmd_status)
+    if argv[:1] == ["list"]:
+        if len(argv) == 1:
+            return _Args(func=cmd_list, state=None)
+        opt = argv[1:]
+        if len(opt) == 1 and opt[0].startswith("--state="):
+            opt = ["--state", opt[0][len("--state="):]]
+        if len(opt) == 2 and opt[0] == "--state" and opt[1] in _STATES:
+            return _Args(func=cmd_list, state=opt[1])
+    return None
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
+    args = _fast_args(argv)
+    if args is not None:
+        return args.func(args)
     parser = build_parser()
     args = parser.parse_args(argv)
     if not hasattr(args, "func"):
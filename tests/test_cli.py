@@ -0,0 +1,81 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import queuectl
+from qctl import db, db_pool
+
+
+class CliTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="qctl-test-")
+        self.dbpath = os.path.join(self.tmp, "queue.db")
+        for patch in (
+            mock.patch.object(queuectl, "DB_PATH", self.dbpath),
+            mock.patch.object(queuectl, "_ready", None),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        db_pool.release()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _run(self, argv, stdin=""):
+        out = io.StringIO()
+        with mock.patch("sys.stdin", io.StringIO(stdin)), contextlib.redirect_stdout(out):
+            rc = queuectl.main(argv)
+        return rc, out.getvalue()
+
+    def test_enqueue_batch_rejects_non_objects(self):
+        for payload in ("[1,2]", '"job"\n', '{"id":"ok","command":"echo"}\n5\n'):
+            rc, out = self._run(["enqueue-batch"], payload)
+            self.assertEqual(rc, 2, payload)
+            self.assertIn("Invalid JSON", out)
+        self.assertEqual(db.list_jobs(self.dbpath), [])
+
+    def test_enqueue_batch_reads_ndjson(self):
+        rc, out = self._run(["enqueue-batch"], '{"id":"n1","command":"echo"}\n{"id":"n2","command":"echo"}\n')
+        self.assertIsNone(rc)
+        self.assertEqual([r["id"] for r in db.list_jobs(self.dbpath)], ["n1", "n2"])
+
+    def test_list_escapes_non_ascii(self):
+        command = "echo caf\u00e9 \u20ac \U0001f600"
+        self._run(["enqueue", json.dumps({"id": "u1", "command": command})])
+        rc, out = self._run(["list"])
+        self.assertTrue(out.isascii(), out)
+        self.assertIn('"echo caf\\u00e9 \\u20ac \\ud83d\\ude00"', out)
+        self.assertEqual(json.loads(out)["command"], command)
+
+    def _corrupt_db(self):
+        with open(self.dbpath, "wb") as f:
+            f.write(b"not a database" * 512)
+
+    def test_corrupt_db_is_fatal_by_default(self):
+        self._corrupt_db()
+        with mock.patch.dict(os.environ, {"QCTL_CORRUPTED_BEHAVIOR": ""}):
+            with self.assertRaises(sqlite3.DatabaseError):
+                queuectl.ensure_db()
+        self.assertEqual(os.listdir(self.tmp), ["queue.db"])
+
+    def test_corrupt_db_moved_aside_on_delete(self):
+        self._corrupt_db()
+        with mock.patch.dict(os.environ, {"QCTL_CORRUPTED_BEHAVIOR": "delete"}), contextlib.redirect_stderr(io.StringIO()):
+            queuectl.ensure_db()
+        aside = [n for n in os.listdir(self.tmp) if n.startswith("queue.db.corrupt-")]
+        self.assertEqual(len(aside), 1)
+        with open(os.path.join(self.tmp, aside[0]), "rb") as f:
+            self.assertTrue(f.read().startswith(b"not a database"))
+        rc, _ = self._run(["enqueue", '{"id":"c1","command":"echo"}'])
+        self.assertIsNone(rc)
+        self.assertEqual([r["id"] for r in db.list_jobs(self.dbpath)], ["c1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,13 @@
+import contextlib
+import io
 import os
+import sqlite3
 import tempfile
+import threading
 import unittest
-from qctl import db
+from unittest import mock
+
+from qctl import db, db_pool
 
 
 class CoreTests(unittest.TestCase):
@@ -16,11 +22,63 @@ class CoreTests(unittest.TestCase):
         db.init_db(self.dbpath)
 
     def tearDown(self):
+        db_pool.release()
         try:
             os.remove(self.dbpath)
         except Exception:
             pass
 
+    def test_new_db_uses_8k_pages(self):
+        conn = db_pool.get_conn(self.dbpath)
+        self.assertEqual(conn.execute("PRAGMA page_size").fetchone()[0], 8192)
+
+    def test_finalize_keeps_the_error_when_sqlite_rolled_back(self):
+        db.enqueue_job(self.dbpath, {"id": "f1", "command": "echo"})
+
+        def full(conn, job_id):
+            conn.execute("ROLLBACK")  # what SQLite does itself on SQLITE_FULL
+            raise sqlite3.OperationalError("database or disk is full")
+
+        with mock.patch.object(db, "_complete", full):
+            with self.assertRaisesRegex(sqlite3.OperationalError, "disk is full"):
+                db.finalize_job(self.dbpath, "f1", True)
+        self.assertFalse(db_pool.get_conn(self.dbpath).in_transaction)
+
+    def _reopen(self):
+        db_pool.release(self.dbpath)
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            conn = db_pool.get_conn(self.dbpath)
+        return conn, err.getvalue()
+
+    def test_durability_pragmas_follow_config(self):
+        db.set_config(self.dbpath, "synchronous", "off")
+        db.set_config(self.dbpath, "journal_mode", "memory")
+        conn, err = self._reopen()
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 0)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "memory")
+        self.assertEqual(err, "")
+
+    def test_invalid_durability_config_falls_back_with_warning(self):
+        db.set_config(self.dbpath, "synchronous", "sometimes")
+        conn, err = self._reopen()
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)  # NORMAL
+        self.assertIn("synchronous", err)
+
+    def test_failed_journal_mode_switch_warns(self):
+        db.set_config(self.dbpath, "journal_mode", "MEMORY")
+        # another open connection keeps the db in WAL
+        other = db_pool.get_conn(self.dbpath)
+        other.execute("SELECT 1 FROM jobs").fetchall()
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            conn = db._open(self.dbpath)
+        try:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            self.assertIn("journal_mode", err.getvalue())
+        finally:
+            conn.close()
+
     def test_enqueue_and_list(self):
         job = {"id": "t1", "command": "echo x", "max_retries": 1}
         db.enqueue_job(self.dbpath, job)
@@ -28,6 +86,30 @@ class CoreTests(unittest.TestCase):
         self.assertEqual(len(rows), 1)
         self.assertEqual(rows[0]["id"], "t1")
 
+    def test_enqueue_duplicate_id_raises(self):
+        db.enqueue_job(self.dbpath, {"id": "d1", "command": "echo a"})
+        with self.assertRaises(db.DuplicateJobError):
+            db.enqueue_job(self.dbpath, {"id": "d1", "command": "echo b"})
+        rows = db.list_jobs(self.dbpath)
+        self.assertEqual([(r["id"], r["command"]) for r in rows], [("d1", "echo a")])
+
+    def test_enqueue_jobs_is_all_or_nothing(self):
+        n = db.enqueue_jobs(self.dbpath, [{"id": "e1", "command": "echo"}, {"id": "e2", "command": "echo"}])
+        self.assertEqual(n, 2)
+        with self.assertRaises(Exception):
+            db.enqueue_jobs(self.dbpath, [{"id": "e3", "command": "echo"}, {"id": "e1", "command": "echo"}])
+        ids = [r["id"] for r in db.list_jobs(self.dbpath)]
+        self.assertEqual(sorted(ids), ["e1", "e2"])
+
+    def test_list_jobs_json_matches_list_jobs(self):
+        import json
+
+        db.enqueue_job(self.dbpath, {"id": "j1", "command": "echo \"hi\"", "created_at": "2025-01-01T00:00:00Z"})
+        db.enqueue_job(self.dbpath, {"id": "j2", "command": "echo", "created_at": "2025-01-01T00:00:01Z"})
+        rows = [json.loads(t) for t in db.list_jobs_json(self.dbpath)]
+        self.assertEqual(rows, db.list_jobs(self.dbpath))
+        self.assertEqual([json.loads(t)["id"] for t in db.list_jobs_json(self.dbpath, state="pending")], ["j1", "j2"])
+
     def test_fail_and_dlq(self):
         job = {"id": "t2", "command": "falsecmd", "max_retries": 0}
         db.enqueue_job(self.dbpath, job)
@@ -40,6 +122,82 @@ class CoreTests(unittest.TestCase):
         rows = db.list_jobs(self.dbpath, state="dead")
         self.assertTrue(any(r["id"] == "t2" for r in rows))
 
+    def test_fetch_claims_each_job_once(self):
+        db.enqueue_job(self.dbpath, {"id": "c1", "command": "echo a", "created_at": "2025-01-01T00:00:00Z"})
+        db.enqueue_job(self.dbpath, {"id": "c2", "command": "echo b", "created_at": "2025-01-01T00:00:01Z"})
+        first = db.fetch_and_lock_job(self.dbpath)
+        second = db.fetch_and_lock_job(self.dbpath)
+        self.assertEqual([first["id"], second["id"]], ["c1", "c2"])
+        self.assertEqual(first["state"], "processing")
+        self.assertIsNone(db.fetch_and_lock_job(self.dbpath))
+
+    def test_concurrent_claims_never_share_a_job(self):
+        for i in range(40):
+            db.enqueue_job(self.dbpath, {"id": f"r{i}", "command": "echo"})
+        claimed = []
+
+        def claim():
+            while True:
+                j = db.fetch_and_lock_job(self.dbpath)
+                if j is None:
+                    break
+                claimed.append(j["id"])
+            db_pool.release(self.dbpath)
+
+        threads = [threading.Thread(target=claim) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(claimed), sorted(f"r{i}" for i in range(40)))
+
+    def test_batch_claim_and_release(self):
+        for i in range(3):
+            db.enqueue_job(self.dbpath, {"id": f"b{i}", "command": "echo", "created_at": f"2025-01-01T00:00:0{i}Z"})
+        jobs = db.fetch_and_lock_batch(self.dbpath, limit=2)
+        self.assertEqual([j["id"] for j in jobs], ["b0", "b1"])
+        db.release_jobs(self.dbpath, ["b1"])
+        pending = [r["id"] for r in db.list_jobs(self.dbpath, state="pending")]
+        self.assertEqual(pending, ["b1", "b2"])
+
+    def test_claim_records_worker_id(self):
+        db.enqueue_job(self.dbpath, {"id": "w1", "command": "echo"})
+        db.fetch_and_lock_job(self.dbpath, worker_id="123-1")
+        conn = db_pool.get_conn(self.dbpath)
+        self.assertEqual(conn.execute("SELECT worker_id FROM jobs WHERE id='w1'").fetchone()[0], "123-1")
+        db.release_jobs(self.dbpath, ["w1"])
+        self.assertIsNone(conn.execute("SELECT worker_id FROM jobs WHERE id='w1'").fetchone()[0])
+
+    def test_claim_assigns_default_log_path(self):
+        logs = os.path.join(tempfile.gettempdir(), "qctl-logs")
+        db.enqueue_job(self.dbpath, {"id": "l1", "command": "echo"})
+        j = db.fetch_and_lock_job(self.dbpath, logs_dir=logs)
+        self.assertEqual(j["log_path"], os.path.join(logs, "l1.log"))
+
+    def test_finalize_updates_job_and_metrics(self):
+        db.enqueue_job(self.dbpath, {"id": "f1", "command": "echo a"})
+        db.enqueue_job(self.dbpath, {"id": "f2", "command": "falsecmd", "max_retries": 0})
+        db.finalize_job(self.dbpath, "f1", True)
+        db.finalize_job(self.dbpath, "f2", False, "err", attempts=0, max_retries=0)
+        self.assertEqual([r["id"] for r in db.list_jobs(self.dbpath, state="completed")], ["f1"])
+        self.assertEqual([r["id"] for r in db.list_jobs(self.dbpath, state="dead")], ["f2"])
+        metrics = dict(db_pool.get_conn(self.dbpath).execute("SELECT key, value FROM metrics"))
+        self.assertEqual(metrics["jobs_processed"], 1)
+        self.assertEqual(metrics["jobs_failed"], 1)
+
+    def test_finalize_jobs_batches_outcomes(self):
+        db.enqueue_jobs(self.dbpath, [{"id": f"g{i}", "command": "echo"} for i in range(3)])
+        db.finalize_jobs(self.dbpath, [
+            ("g0", True, None, 0, 3, 2),
+            ("g1", True, None, 0, 3, 2),
+            ("g2", False, "err", 0, 3, 2),
+        ])
+        states = {r["id"]: r["state"] for r in db.list_jobs(self.dbpath)}
+        self.assertEqual(states, {"g0": "completed", "g1": "completed", "g2": "pending"})
+        metrics = dict(db_pool.get_conn(self.dbpath).execute("SELECT key, value FROM metrics"))
+        self.assertEqual(metrics["jobs_processed"], 2)
+        self.assertEqual(metrics["jobs_retried"], 1)
+
     def test_dlq_retry(self):
         job = {"id": "t3", "command": "dummy", "max_retries": 0}
         db.enqueue_job(self.dbpath, job)
@@ -0,0 +1,215 @@
+import os
+import queue
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from qctl import db, db_pool, worker
+
+
+class CompletionFlusherTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.dbpath = tempfile.mkstemp(prefix="qctl-test-", suffix=".db")
+        os.close(fd)
+        os.remove(self.dbpath)
+        db.init_db(self.dbpath)
+        db.enqueue_jobs(self.dbpath, [{"id": "j1", "command": "echo"}, {"id": "j2", "command": "echo"}])
+
+    def tearDown(self):
+        db_pool.release()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.dbpath + suffix)
+            except OSError:
+                pass
+
+    def _flush(self, *outcomes):
+        flusher = worker.CompletionFlusher(self.dbpath)
+        flusher.start()
+        for outcome in outcomes:
+            flusher.submit(outcome)
+        flusher.stop()
+
+    def _states(self):
+        return {r["id"]: r["state"] for r in db.list_jobs(self.dbpath)}
+
+    def test_outcome_lands_after_a_failed_write(self):
+        real = db.finalize_jobs
+        calls = []
+
+        def flaky(dbpath, outcomes):
+            calls.append(outcomes)
+            if len(calls) == 1:
+                raise sqlite3.DatabaseError("database disk image is malformed")
+            return real(dbpath, outcomes)
+
+        with mock.patch.object(db, "finalize_jobs", flaky):
+            self._flush(("j1", True, None, 0, 3, 2))
+        self.assertEqual(self._states()["j1"], "completed")
+
+    def test_bad_outcome_does_not_sink_the_batch(self):
+        self._flush(("j1", True, None, 0, 3, 2), ("j2",))
+        self.assertEqual(self._states(), {"j1": "completed", "j2": "pending"})
+
+    def test_permanent_write_error_does_not_hang_stop(self):
+        def readonly(*args, **kwargs):
+            e = sqlite3.OperationalError("attempt to write a readonly database")
+            e.sqlite_errorcode = sqlite3.SQLITE_READONLY
+            raise e
+
+        done = threading.Event()
+
+        def flush():
+            self._flush(("j1", True, None, 0, 3, 2))
+            done.set()
+
+        with mock.patch.object(db, "finalize_jobs", readonly):
+            threading.Thread(target=flush, daemon=True).start()
+            self.assertTrue(done.wait(3), "stop() still blocked")
+        self.assertEqual(self._states()["j1"], "pending")
+
+    def test_busy_write_is_retried(self):
+        real = db.finalize_jobs
+        calls = []
+
+        def busy_once(dbpath, outcomes):
+            calls.append(outcomes)
+            if len(calls) <= 2:
+                e = sqlite3.OperationalError("database is locked")
+                e.sqlite_errorcode = sqlite3.SQLITE_BUSY
+                raise e
+            return real(dbpath, outcomes)
+
+        with mock.patch.object(db, "finalize_jobs", busy_once):
+            self._flush(("j1", True, None, 0, 3, 2))
+        self.assertEqual(self._states()["j1"], "completed")
+
+
+class ThreadModeTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="qctl-test-")
+        self.dbpath = os.path.join(self.tmp, "queue.db")
+        db.init_db(self.dbpath)
+
+    def tearDown(self):
+        db_pool.release()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_pool_worker_records_its_worker_id(self):
+        db.enqueue_job(self.dbpath, {"id": "a1", "command": "echo"})
+        jobs = queue.SimpleQueue()
+        for job in db.fetch_and_lock_batch(self.dbpath, worker_id="1-dispatch"):
+            jobs.put(job)
+        jobs.put(None)
+        flusher = worker.CompletionFlusher(self.dbpath)
+        flusher.start()
+        worker._pool_worker(7, self.dbpath, jobs, threading.Semaphore(0), 2, 5, self.tmp, flusher)
+        flusher.stop()
+        row = db_pool.get_conn(self.dbpath).execute("SELECT state, worker_id FROM jobs WHERE id='a1'").fetchone()
+        self.assertEqual(row, ("completed", f"{os.getpid()}-7"))
+
+    def test_interrupted_job_is_released_without_an_attempt(self):
+        db.enqueue_job(self.dbpath, {"id": "p1", "command": "python -c pass", "max_retries": 0})
+        (job,) = db.fetch_and_lock_batch(self.dbpath)
+        flusher = mock.Mock()
+        with mock.patch.object(worker, "_run_command", side_effect=worker._PoolInterrupted()):
+            worker._process_job(self.dbpath, job, 1, 2, 5, self.tmp, flusher)
+        flusher.submit.assert_not_called()
+        row = db_pool.get_conn(self.dbpath).execute("SELECT state, attempts FROM jobs WHERE id='p1'").fetchone()
+        self.assertEqual(row, ("pending", 0))
+
+    def _dispatch(self, claim):
+        stop = threading.Event()
+        args = (self.dbpath, stop, queue.SimpleQueue(), threading.Semaphore(2), 2, self.tmp)
+        with mock.patch.object(db, "fetch_and_lock_batch", claim):
+            t = threading.Thread(target=worker._dispatch_loop, args=args)
+            t.start()
+            stopped_itself = stop.wait(0.3)
+            stop.set()
+            t.join()
+        return stopped_itself
+
+    def test_dispatcher_survives_db_errors(self):
+        def claim(*args, **kwargs):
+            raise sqlite3.DatabaseError("database disk image is malformed")
+
+        self.assertFalse(self._dispatch(claim))
+
+    def test_dispatcher_failure_stops_the_run(self):
+        def claim(*args, **kwargs):
+            raise ValueError("bug")
+
+        self.assertTrue(self._dispatch(claim))
+
+
+class PythonPoolTests(unittest.TestCase):
+    def test_restart_interrupts_neighbour(self):
+        worker._start_py_pool(2)
+        self.addCleanup(worker._stop_py_pool)
+        results = {}
+
+        def run(name, code, timeout):
+            try:
+                results[name] = worker._run_in_py_pool(code, [], timeout)
+            except Exception as e:
+                results[name] = e
+
+        neighbour = threading.Thread(target=run, args=("neighbour", "import time; time.sleep(3)", 10))
+        neighbour.start()
+        # the slow job times out while the neighbour is still running
+        run("slow", "import time; time.sleep(5)", 0.5)
+        neighbour.join()
+        self.assertIsInstance(results["slow"], subprocess.TimeoutExpired)
+        # told apart from a failure of its own, so it can be released
+        self.assertIsInstance(results["neighbour"], worker._PoolInterrupted)
+
+    def test_output_is_captured_at_the_fd_level(self):
+        worker._start_py_pool(1)
+        self.addCleanup(worker._stop_py_pool)
+        code = (
+            "import os, subprocess, sys; print('py'); sys.stdout.flush(); os.write(1, b'raw\\n'); "
+            "subprocess.run(['echo', 'child']); sys.stderr.buffer.write(b'err\\n')"
+        )
+        rc, out, err = worker._run_in_py_pool(code, [], 10)
+        self.assertEqual((rc, out, err), (0, "py\nraw\nchild\n", "err\n"))
+        # the interpreter's own fds are back in place for the next job
+        self.assertEqual(worker._run_in_py_pool("print('next')", [], 10), (0, "next\n", ""))
+
+    def test_crashed_interpreter_restarts_pool(self):
+        worker._start_py_pool(1)
+        self.addCleanup(worker._stop_py_pool)
+        crashed = worker._py_pool
+        with self.assertRaisesRegex(RuntimeError, "interpreter died"):
+            worker._run_in_py_pool("import os; os._exit(3)", [], 10)
+        self.assertIsNot(worker._py_pool, crashed)
+        self.assertEqual(worker._run_in_py_pool("print('ok')", [], 10), (0, "ok\n", ""))
+
+    def test_simultaneous_timeouts_restart_once(self):
+        worker._start_py_pool(2)
+        self.addCleanup(worker._stop_py_pool)
+        errors = []
+
+        def run():
+            try:
+                worker._run_in_py_pool("import time; time.sleep(5)", [], 0.5)
+            except (subprocess.TimeoutExpired, worker._PoolInterrupted) as e:
+                # the later one may already see the pool the first one killed
+                errors.append(e)
+
+        with mock.patch.object(worker, "_new_py_pool", wraps=worker._new_py_pool) as new_pool:
+            threads = [threading.Thread(target=run) for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(new_pool.call_count, 1)
+        self.assertEqual(worker._run_in_py_pool("print('ok')", [], 10), (0, "ok\n", ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
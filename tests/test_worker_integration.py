@@ -3,6 +3,7 @@ import time
 import subprocess
 import tempfile
 import unittest
+from unittest import mock
 
 
 class WorkerIntegrationTests(unittest.TestCase):
@@ -10,35 +11,49 @@ class WorkerIntegrationTests(unittest.TestCase):
         self.cwd = os.getcwd()
 
     def test_workers_process_jobs_once(self):
-        # use a temp copy of the project folder to avoid clashing DB
+        # run the real sources against a temp DB to avoid clashing with queue.db
         tmp = tempfile.mkdtemp(prefix="qctl-int-")
-        # copy files
         import shutil
-        shutil.copytree(self.cwd, os.path.join(tmp, "work"), dirs_exist_ok=True)
-        workdir = os.path.join(tmp, "work")
-        # enqueue a bunch of simple jobs
-        cmds = []
-        for i in range(5):
-            # use a simple cross-platform command
-            job = '{"id":"wj%d","command":"echo x","max_retries":1}' % i
-            cmds.append(['python', 'queuectl.py', 'enqueue', job])
-        # run enqueues
-        for c in cmds:
-            subprocess.check_call(c, cwd=workdir)
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        workdir = self.cwd
+        env = dict(os.environ, QCTL_DB=os.path.join(tmp, "queue.db"))
+        # enqueue a bunch of simple jobs in one in-process call; only the
+        # worker needs its own process
+        # use a simple cross-platform command
+        jobs = os.path.join(tmp, "jobs.ndjson")
+        with open(jobs, "w") as f:
+            f.writelines('{"id":"wj%d","command":"echo x","max_retries":1}\n' % i for i in range(5))
+        import queuectl
+        from qctl import db_pool
+        patch = mock.patch.object(queuectl, "DB_PATH", env["QCTL_DB"])
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(db_pool.release, env["QCTL_DB"])
+        self.assertIsNone(queuectl.main(['enqueue-batch', '--file', jobs]))
 
-        # start worker in background
-        p = subprocess.Popen(['python', 'queuectl.py', 'worker', 'start', '--count', '2'], cwd=workdir)
+        # start worker in background; its first line is READY
+        p = subprocess.Popen(['python', 'queuectl.py', 'worker', 'start', '--count', '2'], cwd=workdir, env=env,
+                             stdout=subprocess.PIPE, text=True)
         try:
-            time.sleep(6)
-            # request stop
-            subprocess.check_call(['python', 'queuectl.py', 'worker', 'stop'], cwd=workdir)
-            p.wait(timeout=10)
+            # READY is the first line, alone, before any worker output
+            self.assertEqual(p.stdout.readline().strip(), 'READY')
+            # wait until every job is completed or dead rather than a flat sleep
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                states = queuectl.get_stats_dict()
+                if states.get('completed', 0) + states.get('dead', 0) >= 5:
+                    break
+                time.sleep(0.05)
+            # request stop, then read until the worker reports STOPPED and exits
+            queuectl.main(['worker', 'stop'])
+            rest, _ = p.communicate(timeout=10)
+            self.assertEqual(rest.splitlines()[-1], 'STOPPED')
         finally:
             if p.poll() is None:
                 p.terminate()
 
         # check all wj* jobs are completed or dead (not pending/processing)
-        out = subprocess.check_output(['python', 'queuectl.py', 'list'], cwd=workdir)
+        out = subprocess.check_output(['python', 'queuectl.py', 'list'], cwd=workdir, env=env)
         lines = out.decode('utf-8').strip().splitlines()
         states = {}
         import json